@@ -1,13 +1,17 @@
 from datetime import datetime
 from typing import Dict, List, Optional
+import json
 import sqlite3
 import logging
 
-from vpnmon.database import Database
+from vpnmon.database import Database, current_month_and_prev
 from vpnmon.wireguard import WireGuard
 
 logger = logging.getLogger(__name__)
 
+# Precomputed so per-row conversion is one multiply instead of a division chain
+_INV_GIB = 1.0 / (1024 * 1024 * 1024)
+
 class VPNMonitor:
     def __init__(self, interface: str = "wg0", data_dir = None):
         self.wireguard = WireGuard(interface)
@@ -21,18 +25,35 @@ class VPNMonitor:
 
 
 
-    def collect_data(self):
-        """Collect current data from WireGuard and store in database."""
-        peers = self.wireguard.get_peer_data()
-        if not peers:
+    def collect_data(self, month: str = None):
+        """Collect current data from WireGuard and store in database.
+
+        Args:
+            month: 'YYYY-MM' bucket to store into; defaults to the
+                current month via the shared memoized helper.
+        """
+        try:
+            rows = list(self.wireguard.iter_peer_rows())
+        except OSError:
+            logger.exception("Error reading WireGuard peer data")
+            return False
+        if not rows:
             return False
-        
-        current_month = datetime.now().strftime('%Y-%m')
 
-        with sqlite3.connect(self.db.db_file) as conn:
-            for peer in peers:
-                self.db.ensure_peer_exists(conn, peer['public_key'])
-                self.db.store_measurement(conn, peer, current_month)  
+        if month is None:
+            # Same cached string the usage queries use, so one
+            # computation per calendar month covers both sides
+            month, _ = current_month_and_prev()
+
+        # Both batches commit together in one immediate transaction,
+        # so a collect cycle costs one commit regardless of peer count
+        with self.db.write_transaction() as conn:
+            self.db.ensure_peers_exist(conn, (row[0] for row in rows))
+            self.db.store_measurement_rows(conn, rows, month)
+
+            # Keep planner statistics fresh as the tables grow;
+            # cheap no-op when nothing has changed enough to matter
+            conn.execute("PRAGMA optimize")
 
         return True
     
@@ -41,24 +62,24 @@ class VPNMonitor:
     def get_usage(self, public_key: str = None, month: str = None, monthly_only: bool = True):
         """Get formatted usage data."""
         raw_data = self.db.get_peer_usage(public_key, month, monthly_only)
-        formatted_data = []
-
-        for row in raw_data:
-            received_gb = round(row[4] / (1024 * 1024 * 1024), 2)
-            sent_gb = round(row[5] / (1024 * 1024 * 1024), 2)
-            total_gb = round((row[4] + row[5]) / (1024 * 1024 * 1024), 2)
-
-            formatted_data.append({
-                'public_key': row[0],
-                'name': row[1] or 'Unknown',
-                'email': row[2] or 'Unknown',
-                'month': row[3],
-                'received_gb': received_gb,
-                'sent_gb': sent_gb,
-                'total_gb': total_gb,
-                'last_updated': row[6]
-            })
-        return formatted_data
+
+        # One comprehension pass; rows are sqlite3.Row, so columns are
+        # addressed by name instead of position and survive SELECT
+        # reordering. Dict literals evaluate in order, so the walrus
+        # bindings are in place before the total
+        return [
+            {
+                'public_key': row['public_key'],
+                'name': row['name'] or 'Unknown',
+                'email': row['email'] or 'Unknown',
+                'month': row['year_month'],
+                'received_gb': round((received := row['received']) * _INV_GIB, 2),
+                'sent_gb': round((sent := row['sent']) * _INV_GIB, 2),
+                'total_gb': round((received + sent) * _INV_GIB, 2),
+                'last_updated': row['last_updated']
+            }
+            for row in raw_data
+        ]
     
 
     
@@ -125,38 +146,52 @@ class VPNMonitor:
 
         # Get active peers from WireGUard
         wg_peers = self.wireguard.get_peer_data()
-        wg_keys = set(peer['public_key'] for peer in wg_peers)
-
-        # Get all peers from database
-        with sqlite3.connect(self.db.db_file) as conn:
-            db_peers = conn.execute("SELECT public_key FROM peers").fetchall()
-        db_keys = set(peer[0] for peer in db_peers)
-
-        # Find inconsistencies
-        missing_in_db = wg_keys - db_keys
-        missing_in_wg = db_keys - wg_keys
+        wg_json = json.dumps([peer['public_key'] for peer in wg_peers])
+
+        # Hand the interface keys to SQLite as a JSON array and let
+        # EXCEPT compute both difference sets against the peers table,
+        # instead of materializing every db key into a Python set
+        with self.db.connect() as conn:
+            missing_in_db = [row[0] for row in conn.execute(
+                "WITH wg(k) AS (SELECT value FROM json_each(?)) "
+                "SELECT k FROM wg EXCEPT SELECT public_key FROM peers",
+                (wg_json,))]
+            missing_in_wg = [row[0] for row in conn.execute(
+                "SELECT public_key FROM peers "
+                "EXCEPT SELECT value FROM json_each(?)",
+                (wg_json,))]
+            db_count = conn.execute(
+                "SELECT COUNT(*) FROM peers").fetchone()[0]
 
         result = {
-            'peers_in_wg': len(wg_keys),
-            'peers_in_db': len(db_keys),
-            'missing_in_db': list(missing_in_db),
-            'missing_in_wg': list(missing_in_wg),
+            'peers_in_wg': len(wg_peers),
+            'peers_in_db': db_count,
+            'missing_in_db': missing_in_db,
+            'missing_in_wg': missing_in_wg,
             'fixed_count': 0
         }
 
-        # Handle auto_fix if requested
-        if auto_fix:
-            # Add missing peers to database
-            for key in missing_in_db:
-                logger.info(f"Adding missing peer {key} to database")
-                self.db.update_peer_info(key, name=f"Auto-added {key[:8]}")
-                result['fixed_count'] += 1
-
-            # Remove database entries for peers not in WireGuard
-            for key in missing_in_wg:
-                logger.info(f"Removing peer {key} from database")
-                self.db.delete_peer(key)
-                result['fixed_count'] += 1
+        # Handle auto_fix if requested: both repairs ride one
+        # transaction via executemany instead of a commit per key
+        if auto_fix and (missing_in_db or missing_in_wg):
+            logger.info(f"Auto-fixing: adding {len(missing_in_db)} peers, "
+                        f"removing {len(missing_in_wg)} stale entries")
+            with self.db.write_transaction() as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO peers (public_key, name) VALUES (?, ?)",
+                    [(key, f"Auto-added {key[:8]}") for key in missing_in_db])
+                # Usage rows first, for databases created before the
+                # schema gained ON DELETE CASCADE
+                conn.executemany(
+                    "DELETE FROM monthly_usage WHERE public_key = ?",
+                    [(key,) for key in missing_in_wg])
+                conn.executemany(
+                    "DELETE FROM peers WHERE public_key = ?",
+                    [(key,) for key in missing_in_wg])
+            result['fixed_count'] = len(missing_in_db) + len(missing_in_wg)
+            # The batch above bypassed the Database insert/delete paths,
+            # so its in-memory peer set must reload
+            self.db.forget_known_peers()
 
         logger.info(f"Sync completed. Found {len(missing_in_db)} peers missing in DB, " + 
                 f"{len(missing_in_wg)} peers missing in WireGuard")
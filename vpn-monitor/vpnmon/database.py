@@ -1,33 +1,211 @@
 # database setup
 
+from contextlib import contextmanager
 from pathlib import Path
+import atexit
 import sqlite3
 import logging
 import os
 from typing import Dict, List, Optional
-from datetime import datetime
+from datetime import datetime, timezone
 
 logger = logging.getLogger(__name__)
 
+# (year, month) -> (ym_str, prev_ym_str); holds at most the current month
+_MONTH_CACHE = {}
+
+def current_month_and_prev():
+    """Return ('YYYY-MM', previous 'YYYY-MM') for right now, memoized.
+
+    The collect loop and the usage queries both need the month string;
+    computing it once per calendar month beats a strftime round-trip
+    per call, and handing both callers the same cached string lets
+    them share one object.
+    """
+    now = datetime.now()
+    key = (now.year, now.month)
+    cached = _MONTH_CACHE.get(key)
+    if cached is None:
+        ym = f"{now.year}-{now.month:02d}"
+        if now.month == 1:
+            prev = f"{now.year - 1}-12"
+        else:
+            prev = f"{now.year}-{now.month - 1:02d}"
+        _MONTH_CACHE.clear()
+        cached = _MONTH_CACHE[key] = (ym, prev)
+    return cached
+
+# Hot-path SQL kept as module constants so repeated calls hand sqlite3
+# the same string object and its statement cache can hit
+_SQL_INSERT_PEER = "INSERT OR IGNORE INTO peers (public_key) VALUES (?)"
+
+_SQL_UPSERT_PEER_INFO = """
+    INSERT INTO peers (public_key, name, email) VALUES (?, ?, ?)
+    ON CONFLICT(public_key) DO UPDATE SET
+        name = COALESCE(excluded.name, name),
+        email = COALESCE(excluded.email, email)
+"""
+
+# The usage queries come in all-peers and single-peer variants,
+# precomposed so each call hands the statement cache one of a fixed set
+# of strings instead of a freshly concatenated one
+_SQL_USAGE_MONTHLY = """
+    SELECT
+        m.public_key,
+        p.name,
+        p.email,
+        m.year_month,
+        CASE WHEN m.accumulated_received - COALESCE(pm.accumulated_received, 0) < 0
+            THEN m.accumulated_received
+            ELSE m.accumulated_received - COALESCE(pm.accumulated_received, 0) END
+            as received,
+        CASE WHEN m.accumulated_sent - COALESCE(pm.accumulated_sent, 0) < 0
+            THEN m.accumulated_sent
+            ELSE m.accumulated_sent - COALESCE(pm.accumulated_sent, 0) END
+            as sent,
+        m.last_updated
+    FROM monthly_usage m
+    LEFT JOIN peers p ON m.public_key = p.public_key
+    LEFT JOIN monthly_usage pm
+        ON pm.public_key = m.public_key AND pm.year_month = ?
+    WHERE m.year_month = ?
+"""
+_SQL_USAGE_MONTHLY_ALL = _SQL_USAGE_MONTHLY + " ORDER BY m.last_updated DESC"
+_SQL_USAGE_MONTHLY_ONE = (
+    _SQL_USAGE_MONTHLY + " AND m.public_key = ? ORDER BY m.last_updated DESC")
+
+_SQL_USAGE_ACCUM = """
+    SELECT
+        m.public_key,
+        p.name,
+        p.email,
+        m.year_month,
+        m.accumulated_received as received,
+        m.accumulated_sent as sent,
+        m.last_updated
+    FROM monthly_usage m
+    LEFT JOIN peers p ON m.public_key = p.public_key
+    WHERE m.year_month = ?
+"""
+_SQL_USAGE_ACCUM_ALL = (
+    _SQL_USAGE_ACCUM + " ORDER BY m.year_month DESC, m.last_updated DESC")
+_SQL_USAGE_ACCUM_ONE = (
+    _SQL_USAGE_ACCUM
+    + " AND m.public_key = ? ORDER BY m.year_month DESC, m.last_updated DESC")
+
+_SQL_UPSERT_USAGE = """
+    INSERT INTO monthly_usage
+    (public_key, year_month, accumulated_received, accumulated_sent,
+    last_received, last_sent, last_updated)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(public_key, year_month) DO UPDATE SET
+        accumulated_received = accumulated_received +
+            CASE WHEN excluded.last_received < last_received
+                THEN excluded.last_received
+                ELSE MAX(0, excluded.last_received - last_received) END,
+        accumulated_sent = accumulated_sent +
+            CASE WHEN excluded.last_sent < last_sent
+                THEN excluded.last_sent
+                ELSE MAX(0, excluded.last_sent - last_sent) END,
+        last_received = excluded.last_received,
+        last_sent = excluded.last_sent,
+        last_updated = excluded.last_updated
+"""
+
+def _utc_timestamp():
+    """One 'YYYY-MM-DD HH:MM:SS' UTC string, same format as SQLite's
+    CURRENT_TIMESTAMP, bound once per batch instead of a clock read
+    per upserted row."""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
 class Database:
     def __init__(self, data_dir=None):
         # Get data directory from environment or use default/passed value
         if data_dir is None:
-            data_dir_str = os.environ.get("WG_DATA_DIR", "/data")
-            data_dir = Path(data_dir_str)
-        
-        self.data_dir = data_dir
-        self.db_file = data_dir / "usage.db"
-        
+            data_dir = os.environ.get("WG_DATA_DIR", "/data")
+
+        # Accept str or Path so callers don't have to care
+        self.data_dir = Path(data_dir)
+        self.db_file = self.data_dir / "usage.db"
+        self._conn = None
+        # Lazily loaded set of known public keys so steady-state
+        # collection skips its INSERT OR IGNORE writes entirely
+        self._known_peers = None
+
     def _ensure_data_dir(self):
         """Ensure data directory exists."""
         self.data_dir.mkdir(parents=True, exist_ok=True)
-        
+
+    def connect(self):
+        """Return the shared connection, opening it on first use.
+
+        Reconnecting per call threw away SQLite's page cache and
+        prepared-statement cache every time; one process-lifetime
+        connection keeps both warm. Callers use `with db.connect() as
+        conn:` exactly as before - on a sqlite3 connection that scopes a
+        transaction, not the connection itself.
+
+        The defaults (rollback journal, synchronous=FULL) fsync on every
+        commit, which dominates the cost of the small per-cycle writes,
+        so WAL and friends are applied when the connection is created.
+        """
+        if self._conn is None:
+            # cached_statements sizes sqlite3's C-level prepared-statement
+            # LRU; the module-constant SQL strings map onto it one-to-one
+            conn = sqlite3.connect(self.db_file, check_same_thread=False,
+                                   cached_statements=128)
+            # Rows come back as sqlite3.Row: positional access and
+            # unpacking still work, and callers can use column names
+            # (C-backed lookup) instead of fragile tuple indexes
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA cache_size=-8000")  # 8 MiB page cache
+            conn.execute("PRAGMA mmap_size=268435456")  # cap, not an allocation
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._conn = conn
+            # Checkpoint the WAL and release the file on interpreter exit
+            atexit.register(conn.close)
+        return self._conn
+
+    @contextmanager
+    def write_transaction(self):
+        """Transaction scope for writers, taking the write lock upfront.
+
+        A deferred transaction only upgrades to a write lock at the
+        first DML statement, which under WAL can surface as
+        SQLITE_BUSY when a reader holds the connection. BEGIN
+        IMMEDIATE grabs the lock at entry instead; commit on success,
+        rollback on exception. Readers keep using plain connect().
+        """
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+
     def init_db(self):
         """Initialize database schema."""
         self._ensure_data_dir() # Make sure directory exists
 
-        with sqlite3.connect(self.db_file) as conn:
+        with self.connect() as conn:
+            # Only takes effect if it runs before the first table is
+            # created - matches the filesystem block size
+            conn.execute("PRAGMA page_size=4096")
+
+            # Incremental auto_vacuum tracks freelist pages so
+            # maintenance() can fold deleted peers' pages back in. The
+            # setting lives in the file header, which the connect-time
+            # pragmas already wrote, so a VACUUM rebuild is needed for
+            # it to stick - cheap at setup size, no-op once applied
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                conn.execute("VACUUM")
+
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS peers (
                     public_key TEXT PRIMARY KEY,
@@ -48,218 +226,183 @@ class Database:
                     last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     PRIMARY KEY (public_key, year_month),
                     FOREIGN KEY (public_key) REFERENCES peers(public_key)
+                        ON DELETE CASCADE
                 )
             """)
-    
+
+            # The usage queries filter on year_month and order by
+            # last_updated; without this the planner scans and sorts
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_usage_month_updated
+                ON monthly_usage(year_month, last_updated DESC)
+            """)
+
+            # delete-peer looks peers up by email
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_peers_email
+                ON peers(email)
+            """)
+
+            # Populate planner statistics so the new index gets picked
+            conn.execute("ANALYZE")
+
+
+
+    def maintenance(self):
+        """Periodic upkeep: reclaim freed pages and refresh planner stats.
+
+        Peer deletions leave freelist pages behind; without reclaiming
+        them the monthly_usage B-tree slowly outgrows its live rows and
+        every scan touches dead pages. Cheap enough to run daily.
+        """
+        conn = self.connect()
+        conn.execute("PRAGMA incremental_vacuum(1000)")
+        conn.execute("PRAGMA optimize")
+
 
 
     def ensure_peer_exists(self, conn, public_key):
         """Make sure the peer is in the peers table."""
-        conn.execute(
+        self.ensure_peers_exist(conn, (public_key,))
+
+
+
+    def ensure_peers_exist(self, conn, public_keys):
+        """Make sure a batch of peers is in the peers table.
+
+        Known keys are tracked in memory, so once the set is warm the
+        steady-state collect tick issues no INSERT at all; only keys the
+        process has not seen yet hit the database.
+        """
+        if self._known_peers is None:
+            self._known_peers = {row[0] for row in
+                                 conn.execute("SELECT public_key FROM peers")}
+        new_keys = [key for key in public_keys if key not in self._known_peers]
+        if new_keys:
+            conn.executemany(_SQL_INSERT_PEER, [(key,) for key in new_keys])
+            self._known_peers.update(new_keys)
+
+
+
+    def forget_known_peers(self):
+        """Drop the in-memory peer set; reloaded on next use.
+
+        For callers that change the peers table without going through
+        this class's insert/delete paths (e.g. sync auto-fix batches).
         """
-        INSERT OR IGNORE INTO peers (public_key)
-        VALUES (?)
-        """,
-        (public_key,))
+        self._known_peers = None
 
 
 
     def get_peer_usage(self, public_key: str = None, month: str = None, monthly_only: bool = True):
-        """Get usage statistics for one or all peers."""
+        """Get usage statistics for one or all peers.
+
+        Returns an iterable cursor over sqlite3.Row results rather than
+        a materialized list: rows stream out of the B-tree as the
+        caller consumes them. Wrap in list() if len or random access
+        is needed.
+        """
         # Default to current month if not specified
         if month is None:
-            month = datetime.now().strftime('%Y-%m')
+            month, prev_month = current_month_and_prev()
+        else:
+            prev_month = None
 
-        with sqlite3.connect(self.db_file) as conn:
+        with self.connect() as conn:
             if monthly_only:
-                # Calculate the previous month
                 try:
-                    year, month_num = map(int, month.split('-'))
-                    if month_num == 1:  # January
-                        prev_month = f"{year-1}-12"
-                    else:
-                        prev_month = f"{year}-{month_num-1:02d}"
-                    
-                    # Get current month's data along with previous month's data
-                    query = """
-                        SELECT 
-                            m.public_key,
-                            p.name,
-                            p.email,
-                            m.year_month,
-                            m.accumulated_received,
-                            m.accumulated_sent,
-                            m.last_updated,
-                            (SELECT accumulated_received FROM monthly_usage 
-                            WHERE public_key = m.public_key AND year_month = ?) as prev_received,
-                            (SELECT accumulated_sent FROM monthly_usage 
-                            WHERE public_key = m.public_key AND year_month = ?) as prev_sent
-                        FROM monthly_usage m
-                        LEFT JOIN peers p ON m.public_key = p.public_key
-                        WHERE m.year_month = ?
-                    """
-                    params = [prev_month, prev_month, month]
+                    # Calculate the previous month for explicit months;
+                    # the default path got it from the cache already
+                    if prev_month is None:
+                        year, month_num = map(int, month.split('-'))
+                        if month_num == 1:  # January
+                            prev_month = f"{year-1}-12"
+                        else:
+                            prev_month = f"{year}-{month_num-1:02d}"
 
+                    # Monthly usage is the difference against the previous
+                    # month's accumulator (self-join on the composite
+                    # primary key); a negative difference means the
+                    # accumulator was rebuilt, so fall back to the full
+                    # value. All computed in the SQLite VM - no Python
+                    # post-processing loop over the rows
                     if public_key:
-                        query += " AND m.public_key = ?"
-                        params.append(public_key)
-                        
-                    query += " ORDER BY m.last_updated DESC"
-                    
-                    rows = conn.execute(query, params).fetchall()
-
-                    # Process rows to calculate monthly-only values
-                    result = []
-                    for row in rows:
-                        # Calculate monthly usage as difference between current and previous
-                        prev_received = row[7] if row[7] is not None else 0
-                        prev_sent = row[8] if row[8] is not None else 0
-                        
-                        monthly_received = row[4] - prev_received
-                        monthly_sent = row[5] - prev_sent
-                        
-                        # Handle counter resets (if monthly is negative, use full value)
-                        if monthly_received < 0:
-                            monthly_received = row[4]
-                        if monthly_sent < 0:
-                            monthly_sent = row[5]
-                        
-                        result.append((row[0], row[1], row[2], row[3], 
-                                    monthly_received, monthly_sent, row[6]))
-                        
-                    return result
+                        return conn.execute(
+                            _SQL_USAGE_MONTHLY_ONE,
+                            (prev_month, month, public_key))
+                    return conn.execute(
+                        _SQL_USAGE_MONTHLY_ALL, (prev_month, month))
                 except Exception as e:
                     logger.exception("Error calculating monthly values")
                     # Fall back to accumulated values
 
 
-            query = """
-                SELECT 
-                    m.public_key,
-                    p.name,
-                    p.email,
-                    m.year_month,
-                    m.accumulated_received,
-                    m.accumulated_sent,
-                    m.last_updated
-                FROM monthly_usage m
-                LEFT JOIN peers p ON m.public_key = p.public_key
-                WHERE m.year_month = ?
-            """
-            params = [month]
-            
             if public_key:
-                query += " AND m.public_key = ?"
-                params.append(public_key)
-                
-            query += " ORDER BY m.year_month DESC, m.last_updated DESC"
-            
-            return conn.execute(query, params).fetchall()
+                return conn.execute(
+                    _SQL_USAGE_ACCUM_ONE, (month, public_key))
+            return conn.execute(_SQL_USAGE_ACCUM_ALL, (month,))
         
 
 
     def store_measurement(self, conn, peer_data, current_month):
             """Store monthly usage data for a peer."""
-            last = conn.execute(
-                """
-                SELECT accumulated_received, accumulated_sent,
-                    last_received, last_sent
-                FROM monthly_usage
-                WHERE public_key = ? AND year_month = ?
-                """, (peer_data['public_key'], current_month)).fetchone()
-            
-            if last:
-                # Check for counter reset
-                if peer_data['received'] < last[2] or peer_data['sent'] < last[3]:
-                    # Counter reset - add new value to accumulated
-                    new_accumulated_received = last[0] + peer_data['received']
-                    new_accumulated_sent = last[1] + peer_data['sent']
-                else:
-                    # Normal case - add the difference
-                    received_diff = peer_data['received'] - last[2]
-                    sent_diff = peer_data['sent'] - last[3]
-                    # Ask why do I need max() here
-                    new_accumulated_received = last[0] + max(0, received_diff)
-                    new_accumulated_sent = last[1] + max(0, sent_diff)
-
-                conn.execute(
-                    """
-                    UPDATE monthly_usage
-                    SET accumulated_received = ?,
-                        accumulated_sent = ?,
-                        last_received = ?,
-                        last_sent = ?,
-                        last_updated = CURRENT_TIMESTAMP
-                    WHERE public_key = ? AND year_month = ?
-                        """, (new_accumulated_received, new_accumulated_sent, 
-                            peer_data['received'], peer_data['sent'],
-                            peer_data['public_key'], current_month))
-            else:
-                # First measurement for this month
-                conn.execute(
-                    """
-                    INSERT INTO monthly_usage 
-                    (public_key, year_month, accumulated_received, accumulated_sent,
-                    last_received, last_sent)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (peer_data['public_key'], current_month,
-                    peer_data['received'], peer_data['sent'],
-                    peer_data['received'], peer_data['sent']))
+            self.store_measurements(conn, [peer_data], current_month)
+
+
+
+    def store_measurements(self, conn, peers_data, current_month):
+            """Store monthly usage data for a batch of peers.
+
+            Single upsert per peer instead of SELECT-then-UPDATE/INSERT: the
+            counter reset check (new counter below the last seen value) and
+            the normal delta accumulation both happen inline in SQL, and
+            executemany reuses the one prepared statement across the batch.
+            """
+            now = _utc_timestamp()
+            conn.executemany(
+                _SQL_UPSERT_USAGE,
+                [(p['public_key'], current_month,
+                  p['received'], p['sent'],
+                  p['received'], p['sent'], now) for p in peers_data])
+
+
+
+    def store_measurement_rows(self, conn, rows, current_month):
+            """Store (public_key, received, sent) tuples for a batch of peers.
+
+            Tuple-based twin of store_measurements for callers that stream
+            rows from WireGuard.iter_peer_rows without building dicts.
+            """
+            now = _utc_timestamp()
+            conn.executemany(
+                _SQL_UPSERT_USAGE,
+                ((pk, current_month, rx, tx, rx, tx, now)
+                 for pk, rx, tx in rows))
             
 
 
     def update_peer_info(self, public_key: str, name: str = None, email: str = None):
             """Update peer information."""
             try:
-                with sqlite3.connect(self.db_file) as conn:
-                    # Check if peer exists
-                    existing = conn.execute(
-                        "SELECT 1 FROM peers WHERE public_key = ?", 
-                        (public_key,)
-                    ).fetchone()
-                    
-                    if existing:
-                        # Update existing peer
-                        logger.info(f"Updating existing peer: {public_key}")
-                        if name is not None or email is not None:
-                            query = "UPDATE peers SET "
-                            params = []
-                            updates = []
-                            
-                            if name is not None:
-                                updates.append("name = ?")
-                                params.append(name)
-                                
-                            if email is not None:
-                                updates.append("email = ?")
-                                params.append(email)
-                                
-                            query += ", ".join(updates)
-                            query += " WHERE public_key = ?"
-                            params.append(public_key)
-                            
-                            conn.execute(query, params)
-                            return True
-                    else:
-                        # Insert new peer
-                        logger.info(f"Inserting new peer: {public_key}, name: {name}, email: {email}")
-                        conn.execute(
-                            "INSERT INTO peers (public_key, name, email) VALUES (?, ?, ?)",
-                            (public_key, name, email)
-                        )
-                        return True
-                
-                return False
+                with self.write_transaction() as conn:
+                    # One upsert round-trip instead of a SELECT existence
+                    # check followed by branch-specific statements; COALESCE
+                    # keeps the stored value when the caller passes None
+                    logger.info("Upserting peer: %s, name: %s, email: %s",
+                                public_key, name, email)
+                    conn.execute(_SQL_UPSERT_PEER_INFO, (public_key, name, email))
+                if self._known_peers is not None:
+                    self._known_peers.add(public_key)
+                return True
             except Exception as e:
-                print(f"Database error: {e}")
-                logger.exception(f"Error updating peer {public_key}")
+                logger.exception("Error updating peer %s", public_key)
                 return False
         
 
 
     def find_peers_by_email(self, email: str) -> List[str]:
         """Find all public keys associated with a given email."""
-        with sqlite3.connect(self.db_file) as conn:
+        with self.connect() as conn:
             query = "SELECT public_key FROM peers WHERE email = ?"
             result = conn.execute(query, (email,)).fetchall()
             return [row[0] for row in result] # Extract public keys from result tuples
@@ -276,24 +419,35 @@ class Database:
         Returns:
             bool: True if successful, False otherwise
         """
-        logger.info(f"Beginning transaction for deletion of {public_key} from the database")
+        logger.info("Beginning transaction for deletion of %s from the database", public_key)
         try:
-            with sqlite3.connect(self.db_file) as conn:
-                # Start a transaction
-                conn.execute("BEGIN TRANSACTION")
+            conn = self.connect()
 
-                # Delete from peers table
-                conn.execute("DELETE FROM peers WHERE public_key = ?", (public_key,))
-
-                # Optionally delete usage records
-                if not keep_usage_history:
+            if keep_usage_history:
+                # Cascade would take the usage rows with the peer, so
+                # suspend enforcement for just this delete (pragmas can't
+                # change inside a transaction, hence outside the block)
+                conn.execute("PRAGMA foreign_keys=OFF")
+                try:
+                    with self.write_transaction() as conn:
+                        conn.execute("DELETE FROM peers WHERE public_key = ?", (public_key,))
+                finally:
+                    conn.execute("PRAGMA foreign_keys=ON")
+            else:
+                # One immediate transaction wraps both deletes: commit on
+                # success, rollback on exception. The explicit usage
+                # delete stays for databases created before the DDL
+                # gained ON DELETE CASCADE; run it first so enforcement
+                # never sees a parent with surviving children
+                with self.write_transaction() as conn:
                     conn.execute("DELETE FROM monthly_usage WHERE public_key = ?", (public_key,))
+                    conn.execute("DELETE FROM peers WHERE public_key = ?", (public_key,))
 
-                # Commit transaction
-                conn.commit()
-                logger.info("Successfully removed the entry from the database")
-                return True
+            if self._known_peers is not None:
+                self._known_peers.discard(public_key)
+            logger.info("Successfully removed the entry from the database")
+            return True
         except Exception as e:
-            logger.exception(f"Error deleting peer {public_key} from database")
+            logger.exception("Error deleting peer %s from database", public_key)
             return False                     
                 
\ No newline at end of file
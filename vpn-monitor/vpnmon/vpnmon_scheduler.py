@@ -1,9 +1,13 @@
 # vpnmon_scheduler.py
 import time
-import subprocess
 import logging
 import sys
-from datetime import datetime
+from pathlib import Path
+
+# Runs as a top-level script in the container, so make the package importable
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from vpnmon.core import VPNMonitor
 
 logging.basicConfig(
     level=logging.INFO,
@@ -13,24 +17,35 @@ logging.basicConfig(
 logger = logging.getLogger("vpnmon-scheduler")
 
 INTERVAL_SECONDS = 300  # 5 minutes
+MAINTENANCE_SECONDS = 86400  # daily vacuum + planner stats refresh
 
-def collect_data():
+def collect_data(monitor):
     logger.info("Running data collection...")
     try:
-        result = subprocess.run(
-            ["/opt/venv/bin/python3", "/app/cli/monitor.py", "collect"], 
-            capture_output=True, 
-            text=True
-        )
-        if result.returncode == 0:
+        if monitor.collect_data():
             logger.info("Data collection successful")
         else:
-            logger.error(f"Data collection failed: {result.stderr}")
+            logger.error("Data collection failed")
     except Exception as e:
         logger.error(f"Error running data collection: {e}")
 
-# Main loop
+# Main loop. Calling collect_data in-process skips a Python interpreter
+# launch, module imports and a fresh SQLite connection every tick; the
+# monitor's shared connection stays warm across iterations. The next-tick
+# arithmetic on time.monotonic keeps the schedule from drifting by the
+# collection's own runtime.
 logger.info(f"Scheduler starting, will collect data every {INTERVAL_SECONDS} seconds")
+monitor = VPNMonitor()
+next_tick = time.monotonic()
+next_maintenance = next_tick + MAINTENANCE_SECONDS
 while True:
-    collect_data()
-    time.sleep(INTERVAL_SECONDS)
\ No newline at end of file
+    collect_data(monitor)
+    now = time.monotonic()
+    if now >= next_maintenance:
+        try:
+            monitor.db.maintenance()
+        except Exception as e:
+            logger.error(f"Error running database maintenance: {e}")
+        next_maintenance = now + MAINTENANCE_SECONDS
+    next_tick += INTERVAL_SECONDS
+    time.sleep(max(0, next_tick - time.monotonic()))
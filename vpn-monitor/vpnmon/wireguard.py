@@ -2,14 +2,34 @@
 
 import subprocess
 import logging
+import re
+import shutil
 import sys
 import os
+import time
+import urllib.request
 from datetime import datetime
 from pathlib import Path
 from typing import List, Dict, Optional
 
 logger = logging.getLogger(__name__)
 
+# Splits a wg config at the start of each [Peer] section
+_PEER_SECTION_RE = re.compile(r'^\[Peer\]\s*\n', re.MULTILINE)
+
+# Per-subnet compiled patterns for AllowedIPs host suffixes; the subnet
+# comes from the environment so the cache normally holds one entry
+_ALLOWED_IP_RE_CACHE = {}
+
+def _allowed_ip_re(subnet_base):
+    pattern = _ALLOWED_IP_RE_CACHE.get(subnet_base)
+    if pattern is None:
+        pattern = _ALLOWED_IP_RE_CACHE[subnet_base] = re.compile(
+            rb'^\s*AllowedIPs\s*=\s*'
+            + re.escape(subnet_base).encode('ascii')
+            + rb'\.(\d+)/', re.MULTILINE)
+    return pattern
+
 class WireGuard:
     def __init__(self, interface: str = None):
         self.interface = interface or os.environ.get("WG_INTERFACE", "wg0")
@@ -21,28 +41,111 @@ class WireGuard:
         self.config_dir = os.path.join(base_config_dir, "wg_confs")
         self.config_file = os.path.join(self.config_dir, f"{self.interface}.conf")
 
-    def get_peer_data(self) -> List[Dict]:
-        """Get current WireGuard statistics for all peers."""
+        # Short-lived cache of the last `wg show` dump so back-to-back
+        # callers (web request + collect) don't fork twice
+        self._peer_data_cache = (0.0, None)
+
+        # The server key never changes at runtime and the public IP
+        # rarely does, so cache both (the endpoint with a TTL)
+        self._cached_pubkey = None
+        self._cached_endpoint = (None, 0.0)
+        self._cached_port = None
+
+    ENDPOINT_TTL = 3600  # seconds; a VPS public IP effectively never changes
+
+    PEER_DATA_TTL = 5  # seconds
+
+    def reload(self):
+        """Drop all cached values.
+
+        Call after the interface or its config is changed outside this
+        class, so the next reads re-fetch instead of serving stale data.
+        """
+        self._peer_data_cache = (0.0, None)
+        self._cached_pubkey = None
+        self._cached_endpoint = (None, 0.0)
+        self._cached_port = None
+
+    def _parse_interface_line(self, line):
+        """Harvest server details from the first line of `wg show dump`.
+
+        The dump's interface line carries private-key, public-key,
+        listen-port and fwmark; every dump we run for peer stats gets
+        the server key and port for free, so get_server_public_key and
+        get_server_endpoint usually never need their own subprocess.
+        """
+        parts = line.split(b'\t')
+        if len(parts) >= 3:
+            if parts[1] != b'(none)':
+                self._cached_pubkey = parts[1].decode('ascii')
+            if parts[2] != b'0':
+                self._cached_port = parts[2].decode('ascii')
+
+    def get_peer_data(self, force: bool = False) -> List[Dict]:
+        """Get current WireGuard statistics for all peers.
+
+        Results are cached for PEER_DATA_TTL seconds; pass force=True to
+        bypass the cache (e.g. for scheduled collection).
+        """
+        cached_at, cached = self._peer_data_cache
+        if not force and cached is not None:
+            if time.monotonic() - cached_at < self.PEER_DATA_TTL:
+                return cached
+
         try:
-            output = subprocess.check_output(
+            # Keep the output as bytes: wg dump is ASCII, so only the
+            # public key needs decoding and the counters parse directly
+            raw = subprocess.run(
                 ["wg", "show", self.interface, "dump"],
-                text=True
-            )
+                check=True, capture_output=True
+            ).stdout
             peers = []
-
-            for line in output.strip().split('\n')[1:]:
-                parts = line.split('\t')
+            lines = raw.splitlines()
+            if lines:
+                self._parse_interface_line(lines[0])
+
+            # splitlines avoids the strip/split double pass, and maxsplit
+            # stops scanning each line once the counter fields are out
+            for line in lines[1:]:
+                parts = line.split(b'\t', 7)
                 if len(parts) >= 7:
+                    received = int(parts[5])
+                    sent = int(parts[6])
                     peers.append({
-                        'public_key': parts[0],
-                        'received': int(parts[5]),
-                        'sent': int(parts[6]),
-                        'total': int(parts[5]) + int(parts[6])
+                        'public_key': parts[0].decode('ascii'),
+                        'received': received,
+                        'sent': sent
                     })
+            self._peer_data_cache = (time.monotonic(), peers)
             return peers
         except subprocess.CalledProcessError as e:
             logger.exception("Error getting WireGuard data")
             return []
+
+
+
+    def iter_peer_rows(self):
+        """Yield (public_key, received, sent) tuples straight from `wg show`.
+
+        Streaming variant of get_peer_data for the collector: rows are
+        parsed from the subprocess pipe as they arrive, with no
+        intermediate dicts and no caching, so counters are always fresh.
+        """
+        proc = subprocess.Popen(
+            ["wg", "show", self.interface, "dump"],
+            stdout=subprocess.PIPE
+        )
+        try:
+            interface_line = next(proc.stdout, None)
+            if interface_line:
+                self._parse_interface_line(interface_line)
+            for line in proc.stdout:
+                parts = line.split(b'\t', 7)
+                if len(parts) >= 7:
+                    yield (parts[0].decode('ascii'), int(parts[5]), int(parts[6]))
+        finally:
+            proc.stdout.close()
+            proc.wait()
         
 
 
@@ -50,14 +153,18 @@ class WireGuard:
     def generate_keys(self):
         """Generate a new WireGuard key pair."""
         try:
-            # Generate private key
-            private_key = subprocess.check_output(["wg", "genkey"], text=True).strip()
-            # Derive public key from private key
-            public_key = subprocess.check_output(["wg", "pubkey"], input=private_key, text=True).strip()
+            # Generate private key, then derive the public key from it.
+            # Keys stay as bytes between the two processes; they are
+            # ASCII base64 so a single decode at the end suffices
+            private_key = subprocess.run(
+                ["wg", "genkey"], check=True, capture_output=True).stdout.strip()
+            public_key = subprocess.run(
+                ["wg", "pubkey"], input=private_key,
+                check=True, capture_output=True).stdout.strip()
 
             return {
-                "private_key": private_key,
-                "public_key": public_key
+                "private_key": private_key.decode('ascii'),
+                "public_key": public_key.decode('ascii')
             }
         except subprocess.CalledProcessError as e:
             logger.exception("Error generating WireGuard keys")
@@ -68,40 +175,53 @@ class WireGuard:
 
     def add_peer_to_config(self, public_key, allowed_ips, config_file=None):
         """Dynamically add a peer to WireGuard and persist it in the config file."""
+        return self.add_peers_to_config([(public_key, allowed_ips)], config_file)
+
+
+
+    def add_peers_to_config(self, peers, config_file=None):
+        """Add a batch of (public_key, allowed_ips) peers in one pass.
+
+        wg set accepts any number of peer clauses, so the whole batch
+        costs one fork and one append-mode write regardless of size.
+        """
         try:
-            # Use the instance config_file if none provided
+            peers = list(peers)
+            if not peers:
+                return True
 
+            # Use the instance config_file if none provided
             config_file = config_file or self.config_file
-            # Apply the peer dynamically
-            logger.info(f"Attempting to set WireGuard peer: {public_key} with allowed IPs: {allowed_ips}")
-            set_result = subprocess.run([
-                "wg", "set", self.interface, "peer", 
-                public_key, "allowed-ips", allowed_ips
-            ], check=False, capture_output=True, text=True)
-            
+
+            # Apply all peers in a single wg invocation
+            logger.info("Attempting to set %d WireGuard peer(s)", len(peers))
+            argv = ["wg", "set", self.interface]
+            for public_key, allowed_ips in peers:
+                argv += ["peer", public_key, "allowed-ips", allowed_ips]
+            set_result = subprocess.run(
+                argv, check=False, capture_output=True, text=True)
+
             if set_result.returncode != 0:
                 logger.error(f"WireGuard set command failed: {set_result.stderr}")
                 return False
-            
-            # Append to the configuration file for persistence 
+
+            # Append to the configuration file for persistence; a plain
+            # append-mode write, no need to fork tee for ~80 bytes each
             logger.info(f"Attempting to update config file: {config_file}")
-            peer_config = f"\n[Peer]\nPublicKey = {public_key}\nAllowedIPs = {allowed_ips}\n"
-            tee_result = subprocess.run(
-                ["tee", "-a", config_file], 
-                input=peer_config, 
-                check=False,
-                capture_output=True,
-                text=True
-            )
-            
-            if tee_result.returncode != 0:
-                logger.error(f"Config file update failed: {tee_result.stderr}")
+            peer_config = ''.join(
+                f"\n[Peer]\nPublicKey = {public_key}\nAllowedIPs = {allowed_ips}\n"
+                for public_key, allowed_ips in peers)
+            try:
+                with open(config_file, "a") as f:
+                    f.write(peer_config)
+            except OSError as e:
+                logger.error(f"Config file update failed: {e}")
                 return False
-                
-            logger.info("Peer added successfully")    
+
+            logger.info("Peer(s) added successfully")
             return True
         except Exception as e:
-            logger.exception("Error adding peer to config")
+            logger.exception("Error adding peers to config")
             return False
     
 
@@ -116,39 +236,30 @@ class WireGuard:
             # Get the subnet from environment or default to 10.0.0
             subnet_base = os.environ.get("WG_SUBNET_BASE", "10.0.0")
 
-            # Read config file using
-            read_result = subprocess.run(
-                ["cat", config_file],
-                check=True, 
-                capture_output=True, 
-                text=True
-            )
-            config_lines = read_result.stdout.splitlines()
-                
-            # Extract all AllowedIPs
-            used_ips = set()
-            for line in config_lines:
-                if line.strip().startswith("AllowedIPs"):
-                    # Extract IP from format like "AllowedIPs = 10.0.0.2/32"
-                    ip_part = line.split("=")[1].strip()
-                    ip = ip_part.split("/")[0].strip()
-                    if ip.startswith(f"{subnet_base}."):
-                        used_ips.add(ip)
-            
-            # Find the first available IP starting from x.x.x.2
-            # (x.x.x.1 is typically the server)
-            for i in range(2, 255):
-                candidate_ip = f"{subnet_base}.{i}"
-                if candidate_ip not in used_ips:
-                    next_ip = f"{candidate_ip}/32"
-                    logger.info(f"Found available IP: {next_ip}")
-                    return next_ip
-                        
-            # If we get here, all IPs are taken (unlikely)
-            logger.error(f"No available IPs in the {subnet_base}.x range")
-            raise RuntimeError("No available IPs in subnet - all 253 addresses are in use")
+            # Read config file directly - no need to fork cat for a few KB.
+            # Bytes mode skips the utf-8 decode; one compiled-regex pass
+            # over the buffer replaces the per-line strip/split churn
+            with open(config_file, "rb") as f:
+                config_data = f.read()
+
+            used_suffixes = {
+                int(match.group(1))
+                for match in _allowed_ip_re(subnet_base).finditer(config_data)
+            }
+
+            # Lowest free suffix starting from x.x.x.2 as a single set
+            # difference (x.x.x.1 is typically the server)
+            free = set(range(2, 255)) - used_suffixes
+            if not free:
+                # All IPs are taken (unlikely)
+                logger.error(f"No available IPs in the {subnet_base}.x range")
+                raise RuntimeError("No available IPs in subnet - all 253 addresses are in use")
+
+            next_ip = f"{subnet_base}.{min(free)}/32"
+            logger.info(f"Found available IP: {next_ip}")
+            return next_ip
         
-        except subprocess.CalledProcessError as e:
+        except OSError as e:
             logger.error(f"Error accessing config file: {e}")
             raise RuntimeError("Cannot determine next available IP - permission denied")
         except Exception as e:
@@ -159,16 +270,20 @@ class WireGuard:
 
     def get_server_public_key(self, config_file=None):
         """Get the server's public key from the config file."""
-        try:   
+        if self._cached_pubkey:
+            return self._cached_pubkey
+
+        try:
              # Use the instance config_file if none provided
             config_file = config_file or self.config_file
 
             # Get the public key
             output = subprocess.check_output(
-                ["wg", "show", self.interface, "public-key"], 
+                ["wg", "show", self.interface, "public-key"],
                 text=True
             )
-            return output.strip()
+            self._cached_pubkey = output.strip()
+            return self._cached_pubkey
         except Exception as e:
             logger.exception("Error getting server public key")
             return None
@@ -177,13 +292,24 @@ class WireGuard:
 
     def get_server_endpoint(self):
         """Get the server's public endpoint address."""
+        endpoint, cached_at = self._cached_endpoint
+        if endpoint and time.monotonic() - cached_at < self.ENDPOINT_TTL:
+            return endpoint
+
         try:
-            # Get public IP from external service
-            ip = subprocess.check_output(["curl", "-s", "https://api.ipify.org"], text=True).strip()
-            
-            # Get port from environment variable or WireGuard
-            port = os.environ.get("SERVERPORT")
+            # The deployment usually bakes the address in (SERVERURL in
+            # docker-compose); only probe the external service when it
+            # is absent or left at linuxserver's 'auto' placeholder
+            ip = os.environ.get("SERVERURL")
+            if not ip or ip == "auto":
+                # In-process urllib instead of forking curl for a
+                # 15-byte response
+                with urllib.request.urlopen("https://api.ipify.org", timeout=5) as resp:
+                    ip = resp.read().decode('ascii').strip()
             
+            # Get port from environment, a previous dump, or WireGuard
+            port = os.environ.get("SERVERPORT") or self._cached_port
+
             if not port:
                 # Try to get from WireGuard if not in environment
                 output = subprocess.check_output(
@@ -195,11 +321,13 @@ class WireGuard:
                         port = line.split(":")[1].strip()
                         break
 
-            # Use default if still not found        
+            # Use default if still not found
             if not port:
                 port = "51820"  # Default port if not found
-            
-            return f"{ip}:{port}"
+
+            endpoint = f"{ip}:{port}"
+            self._cached_endpoint = (endpoint, time.monotonic())
+            return endpoint
         except Exception as e:
             logger.exception("Error getting server endpoint")
             # Use environment variable in fallback too
@@ -233,14 +361,7 @@ class WireGuard:
         """Restore configuration from backup if something goes wrong."""
         try:
             logger.warning(f"Attempting to restore {self.interface}.conf from backup")
-            restore_result = subprocess.run([
-                "cp", "-f", path_to_backup, path_to_conf
-            ], check=False, capture_output=True, text=True)
-            
-            if restore_result.returncode != 0:
-                logger.error(f"Failed to restore from backup: {restore_result.stderr}")
-                return False
-                
+            shutil.copy2(path_to_backup, path_to_conf)
             logger.info(f"Successfully restored {self.interface}.conf from backup")
             return True
         except Exception as e:
@@ -257,113 +378,54 @@ class WireGuard:
         path_to_backup = Path(f"{self.config_file}_backup_")
 
         # Check if file exists
-        try:
-            subprocess.run(
-                ["test", "-f", str(path_to_conf)], 
-                check=True, 
-                stderr=subprocess.PIPE
-            )
-            logger.info("Config found")
-        except subprocess.CalledProcessError:
+        if not path_to_conf.is_file():
             logger.error(f"Configuration file {path_to_conf} does not exist or is not accessible")
             return False
+        logger.info("Config found")
 
-        try:
-            # Attempting to make a backup of .conf
-            logger.info("Attempt on backup creation")
-            make_backup = subprocess.run([
-                "cp", path_to_conf, "-p", path_to_backup
-            ], check=False, capture_output=True, text=True)
-
-            if make_backup.returncode != 0:
-                logger.error(f"{self.interface} backup failed: {make_backup.stderr}")
-                return False
-
-            logger.info(f"{self.interface} backup created successfully")
-        except Exception as e:
-            logger.exception("Error creating backup")
-            return False
-        
-        # Editing .conf 
+        # Parse .conf
         try:
             logger.info(f"Parsing .conf for a peer")
-            read_conf = subprocess.run([
-                "cat", path_to_conf
-            ], check=False, capture_output=True, text=True)
-            conf_lines = read_conf.stdout.split("\n")
-
-           
+            config_text = path_to_conf.read_text()
 
-            # Parse config file
-            keep_lines = []
-            peer_lines = []
-            in_peer_section = False
-            skip_current_peer = False
-            found_peer = False
-            
-            for line in conf_lines:
-                # Start of a new section
-                if line.strip().startswith('['):
-                    if in_peer_section and not skip_current_peer:
-                        # Add the previous peer section if it wasn't skipped
-                        keep_lines.append('[Peer]')
-                        keep_lines.extend(peer_lines)
-
-                    # Reset for new section
-                    if line.strip() == '[Peer]':
-                        in_peer_section = True
-                        skip_current_peer = False
-                        peer_lines = [] # Store peer lines temporarily
-                    else:
-                        # Non-peer section, add directly
-                        in_peer_section = False
-                        keep_lines.append(line)
-                
-                elif in_peer_section:
-                    # Check if this is the peer we want to remove
-                    if line.strip().startswith('PublicKey') and public_key in line:
-                        skip_current_peer = True
-                        found_peer = True
-
-                    # Store the lines for this peer
-                    if not skip_current_peer:
-                        peer_lines.append(line)
-                
-                else:
-                    # Not in a peer section, add directly
-                    keep_lines.append(line)
-
-            # Don't forget to add the last peer section if it exists and wasn't skipped
-            if in_peer_section and not skip_current_peer:
-                keep_lines.append('[Peer]')
-                keep_lines.extend(peer_lines)
-
-            if not found_peer:
+            # Check membership first so the not-found case never touches
+            # the file (no backup, no rewrite)
+            if public_key not in config_text:
                 logger.warning(f"Public key {public_key} not found in configuration")
-
+                return True
+
+            # Split into the header (everything before the first [Peer])
+            # and the peer blocks, then drop the block holding this key -
+            # one regex pass instead of a per-line state machine
+            header, *peer_blocks = _PEER_SECTION_RE.split(config_text)
+            kept_blocks = [block for block in peer_blocks if public_key not in block]
+            modified_content = header + ''.join('[Peer]\n' + block for block in kept_blocks)
         except Exception as e:
             logger.exception(f"Error editing {path_to_conf}")
-            self._restore_config_from_backup(path_to_conf, path_to_backup)
             return False
-            
-        # Join the kept lines back into a single string with newlines
-        modified_content = '\n'.join(keep_lines)
 
-        # Write the modified content back to the config file
+        try:
+            # Hardlink the current file as the backup: zero-copy, and the
+            # old inode stays reachable after the atomic swap below
+            logger.info("Attempt on backup creation")
+            if path_to_backup.exists():
+                path_to_backup.unlink()
+            os.link(path_to_conf, path_to_backup)
+            logger.info(f"{self.interface} backup created successfully")
+        except OSError:
+            logger.exception("Error creating backup")
+            return False
+
+        # Write to a temp file and atomically rename over the config so
+        # a crash mid-write can never leave a torn file behind
+        path_to_tmp = Path(f"{self.config_file}.tmp")
         try:
             logger.info(f"Writing modified configuration to {path_to_conf}")
-            write_result = subprocess.run(
-                ["tee", path_to_conf], 
-                input=modified_content, 
-                check=False,
-                capture_output=True,
-                text=True
-            )
-            
-            if write_result.returncode != 0:
-                logger.error(f"Failed to write modified config: {write_result.stderr}")
-                return False
-                
+            with open(path_to_tmp, "w") as f:
+                f.write(modified_content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path_to_tmp, path_to_conf)
             logger.info(f"Successfully removed peer from {path_to_conf}")
             return True
         except Exception as e:
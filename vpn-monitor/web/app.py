@@ -1,5 +1,7 @@
 from flask import Flask, render_template, request, jsonify
 import sys
+import threading
+import time
 from pathlib import Path
 
 # Add parent directory to path so we can import vpnmon
@@ -9,6 +11,34 @@ from vpnmon.core import VPNMonitor
 app = Flask(__name__)
 monitor = VPNMonitor()
 
+# How stale served usage data may be before a request triggers a
+# fresh collection; the scheduler collects every 5 minutes anyway
+COLLECT_TTL = 10  # seconds
+_last_collected = 0.0
+_collect_lock = threading.Lock()
+
+def _collect_if_stale():
+    """Collect at most once per COLLECT_TTL across all requests.
+
+    Collection forks wg and writes the database; doing that inside
+    every request made each page view pay the full cycle. Requests
+    inside the TTL window serve the data already on disk, and the
+    non-blocking lock stops simultaneous requests from piling
+    concurrent wg forks on an expired window - latecomers just use
+    the data the winner is about to write.
+    """
+    global _last_collected
+    now = time.monotonic()
+    if now - _last_collected < COLLECT_TTL:
+        return
+    if not _collect_lock.acquire(blocking=False):
+        return  # another request is already collecting
+    try:
+        _last_collected = now
+        monitor.collect_data()
+    finally:
+        _collect_lock.release()
+
 @app.route('/')
 def index():
     """Landing page with form to check usage."""
@@ -27,8 +57,8 @@ def usage():
     if not public_key:
         return render_template('index.html', error='Public key is required')
     
-    # Collect fresh data before showing results
-    monitor.collect_data()
+    # Refresh data only if what we have is stale
+    _collect_if_stale()
 
     data = monitor.get_usage(public_key, month)
     return render_template('usage.html', data=data, public_key=public_key)
@@ -39,13 +69,16 @@ def api_usage():
     public_key = request.args.get('public_key')
     month = request.args.get('month')
 
-    # Collect fresh data before returning results
-    monitor.collect_data()
-    
+    # Refresh data only if what we have is stale
+    _collect_if_stale()
+
     data = monitor.get_usage(public_key, month)
     return jsonify(data)
 
 if __name__ == '__main__':
     # Initialize database on startup
     monitor.setup()
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # threaded so a slow collect cycle doesn't serialize other
+    # requests; debug/reloader off - it forked a second interpreter
+    # and re-ran collection in both
+    app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file